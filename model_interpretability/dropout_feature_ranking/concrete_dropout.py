@@ -26,16 +26,20 @@ class ConcreteDropout(nn.Module):
 
         self.parameter_mask = nn.Parameter(init_values)
         self.t = t
+        self._inv_t = 1.0 / t
 
-    def forward(self, input):
-        # sigmoid prevents nan when we take a log of the mask
-        p = torch.sigmoid(self.parameter_mask)
-        uniform_distribution = torch.empty(self.input_shape).uniform_()
+        # a reused noise buffer (not saved in the state_dict), refilled in place on every forward pass
+        self.register_buffer('_noise', torch.empty(input_shape), persistent=False)
 
-        # +1e-7 to prevent nans if p or uniform_distribution = 0
-        mask = torch.sigmoid((1/self.t) * (torch.log(p + 1e-7) - torch.log(1 - p + 1e-7) +
-                                           torch.log(uniform_distribution + 1e-7) -
-                                           torch.log(1 - uniform_distribution + 1e-7)))
+    def forward(self, input):
+        if self._noise.device != input.device or self._noise.dtype != input.dtype:
+            self._noise = self._noise.to(input.device, input.dtype)
+        uniform_distribution = self._noise.uniform_()
+
+        # log(p) - log(1 - p) for p = sigmoid(parameter_mask) is just parameter_mask,
+        # and torch.logit clamps the noise by eps to prevent nans at 0 and 1
+        mask = torch.sigmoid((self.parameter_mask + torch.logit(uniform_distribution, eps=1e-7)) *
+                             self._inv_t)
         if self.training:
             return (1 - mask) * input, mask
         else:
@@ -52,23 +56,5 @@ class ConcreteRegularizer(nn.Module):
     def forward(self, mask):
         """Apply the regularizing weights to concrete dropout
         """
-        return self.lam * torch.sum(mask, tuple(range(mask.ndimension())))
-
-
-class Annealer(object):
-    """
-    A scheduler for the concrete dropout optimizer. Over n batches, linearly
-    increases the learning rate from 0 to max_rate
-    """
-    def __init__(self, optimizer, n=30, max_rate=0.01):
-        self.optimizer = optimizer
-        self.max_rate = max_rate
-        self.stepsize = max_rate / n
-
-        self.current_lr = 0
+        return self.lam * mask.sum()
 
-    def step(self):
-        for param_group in self.optimizer.param_groups:
-            param_group['lr'] = self.current_lr
-        if self.current_lr < self.max_rate:
-            self.current_lr += self.stepsize
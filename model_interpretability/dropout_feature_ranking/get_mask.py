@@ -10,10 +10,11 @@ import os
 import itertools
 import pickle
 from pathlib import Path
+from copy import deepcopy
 from tqdm import tqdm
 from sklearn.metrics import roc_auc_score
 
-from concrete_dropout import ConcreteDropout, ConcreteRegularizer, Annealer
+from concrete_dropout import ConcreteDropout, ConcreteRegularizer
 from models import PhysioNet
 from data import PhysioNetDataset
 
@@ -37,16 +38,21 @@ def train(model_path, concrete_dropout_path, X, Y, normalizing_dict,
     regularizer = ConcreteRegularizer(lam=0.001)
 
     model_optimizer = torch.optim.Adam(model.parameters())
-    dropout_optimizer = torch.optim.Adam(concrete_dropout.parameters())
+    if annealing:
+        # over 30 batches, linearly increase the learning rate from (almost) 0 to 0.01
+        dropout_optimizer = torch.optim.Adam(concrete_dropout.parameters(), lr=0.01)
+        annealer = torch.optim.lr_scheduler.LinearLR(dropout_optimizer, start_factor=1e-8,
+                                                     end_factor=1.0, total_iters=30)
+    else:
+        dropout_optimizer = torch.optim.Adam(concrete_dropout.parameters())
 
     train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
     val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=True)
 
     patience_counter = 0
     best_loss = np.inf
-
-    if annealing:
-        annealer = Annealer(dropout_optimizer)
+    best_model_state = deepcopy(model.state_dict())
+    best_dropout_state = deepcopy(concrete_dropout.state_dict())
 
     if num_epochs:
         epoch_counter = range(1, num_epochs + 1)
@@ -67,7 +73,7 @@ def train(model_path, concrete_dropout_path, X, Y, normalizing_dict,
             dropped_inputs, mask = concrete_dropout(inputs)
             outputs = model(dropped_inputs)
 
-            loss = F.binary_cross_entropy(outputs, targets.unsqueeze(1))
+            loss = F.binary_cross_entropy_with_logits(outputs, targets.unsqueeze(1))
             reg = regularizer(mask)
             total_loss = loss + reg
             total_loss.backward()
@@ -84,7 +90,7 @@ def train(model_path, concrete_dropout_path, X, Y, normalizing_dict,
         predictions_list, targets_list = [], []
         for inputs, targets in val_loader:
             outputs = model(concrete_dropout(inputs))
-            val_loss += F.binary_cross_entropy(outputs, targets.unsqueeze(1)).item()
+            val_loss += F.binary_cross_entropy_with_logits(outputs, targets.unsqueeze(1)).item()
             predictions_list.extend(outputs.data.tolist())
             targets_list.extend(targets.data.tolist())
 
@@ -97,17 +103,19 @@ def train(model_path, concrete_dropout_path, X, Y, normalizing_dict,
             best_loss = val_loss
             patience_counter = 0
             print('Saving new best model')
-            torch.save(model.state_dict(), model_path)
-            torch.save(concrete_dropout.state_dict(), concrete_dropout_path)
+            best_model_state = deepcopy(model.state_dict())
+            best_dropout_state = deepcopy(concrete_dropout.state_dict())
         else:
             patience_counter += 1
         if patience_counter == patience:
             print('Early stopping - best_loss: {:.6g}'.format(best_loss))
             break
 
-    # Load the weights of the best model
-    model.load_state_dict(torch.load(model_path))
-    concrete_dropout.load_state_dict(torch.load(concrete_dropout_path))
+    # Load the weights of the best model, and only write them to disk once
+    model.load_state_dict(best_model_state)
+    concrete_dropout.load_state_dict(best_dropout_state)
+    torch.save(best_model_state, model_path)
+    torch.save(best_dropout_state, concrete_dropout_path)
     return model, concrete_dropout, test_dataset
 
 
@@ -122,7 +130,7 @@ def predict(model, concrete_dropout, predict_dataset):
     output_list, target_list = [], []
     for inputs, targets in predict_loader:
         output = model(concrete_dropout(inputs))
-        loss += F.binary_cross_entropy(output, targets.unsqueeze(1)).data.item()
+        loss += F.binary_cross_entropy_with_logits(output, targets.unsqueeze(1)).data.item()
         output_list.extend(output.tolist())
         target_list.extend(targets.tolist())
     loss /= len(predict_loader)
@@ -168,15 +176,13 @@ def preprocess_data(data_path, masking_features):
         pickle.dump(normalizing_dict, f)
 
 
-def train_val_test_split(X, Y, val_size=0.1, test_size=0.1, return_tensors=True):
-    """Split the input X and Y arrays into train, val and test sets.
-    Stratify according to the Y labels.
+def train_val_test_indices(Y, val_size=0.1, test_size=0.1):
+    """Randomly split the indices of the Y labels (an array or a tensor) into
+    train, val and test indices, stratified according to the labels.
     """
-    change_to_tensor = False
-    if return_tensors and 'numpy' in str(type(X)):
-        change_to_tensor = True
     train_size = 1 - (val_size + test_size)
-    pos_idx, neg_idx = np.where(Y == 1)[0], np.where(Y == 0)[0]
+    labels = Y.numpy() if torch.is_tensor(Y) else Y
+    pos_idx, neg_idx = np.where(labels == 1)[0], np.where(labels == 0)[0]
 
     pos_mask = np.random.uniform(size=len(pos_idx))
     neg_mask = np.random.uniform(size=len(neg_idx))
@@ -185,6 +191,17 @@ def train_val_test_split(X, Y, val_size=0.1, test_size=0.1, return_tensors=True)
     val_idx = np.concatenate((pos_idx[(pos_mask > train_size) & (pos_mask < 1 - test_size)],
                               neg_idx[(neg_mask > train_size) & (neg_mask < 1 - test_size)]))
     test_idx = np.concatenate((pos_idx[pos_mask > 1 - test_size], neg_idx[neg_mask > 1 - test_size]))
+    return train_idx, val_idx, test_idx
+
+
+def train_val_test_split(X, Y, val_size=0.1, test_size=0.1, return_tensors=True):
+    """Split the input X and Y arrays into train, val and test sets.
+    Stratify according to the Y labels.
+    """
+    change_to_tensor = False
+    if return_tensors and 'numpy' in str(type(X)):
+        change_to_tensor = True
+    train_idx, val_idx, test_idx = train_val_test_indices(Y, val_size, test_size)
 
     if change_to_tensor:
         return (torch.FloatTensor(X[train_idx]), torch.FloatTensor(Y[train_idx])), \
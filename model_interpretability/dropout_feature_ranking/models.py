@@ -8,7 +8,8 @@ class PhysioNet(nn.Module):
     "For RNN models, we use a one layer RNN to model the sequence, and then apply a soft-max
     regressor on top of the last hidden state to do classification."
 
-    Default values taken from the dropout feature ranking paper
+    Default values taken from the dropout feature ranking paper. The model returns logits,
+    so it should be trained with binary_cross_entropy_with_logits
     """
     def __init__(self, input_size=74, hidden_size=64):
         super().__init__()
@@ -22,4 +23,5 @@ class PhysioNet(nn.Module):
         output, hidden = self.gru(self.dropout_1(x))
         # we only want the final layer to be returned
         prediction = self.regressor(self.batchnorm(self.dropout_2(output[:, -1, :].squeeze(1))))
-        return torch.sigmoid(prediction)
+        # return logits; the sigmoid is fused into the loss
+        return prediction
@@ -1,9 +1,9 @@
-from get_mask import get_mask, train_val_test_split, preprocess_data as org_preprocessor
+from get_mask import get_mask, train_val_test_indices, preprocess_data as org_preprocessor
 from data import PhysioNetDataset
 from models import PhysioNet
 
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, TensorDataset, SubsetRandomSampler
 import torch.nn.functional as F
 from tqdm import tqdm
 import itertools
@@ -13,28 +13,93 @@ import pandas as pd
 import numpy as np
 import pickle
 import argparse
+from copy import deepcopy
 from sklearn.metrics import roc_auc_score
 
 
-def train(model_path, X, Y, patience, masking_features, k,
-          num_epochs=None, batch_size=64):
-    """ Training loop
-        """
+def get_loader_kwargs():
+    """Keyword arguments shared by all the DataLoaders. Worker processes are
+    kept alive between epochs, which is only possible when there are workers.
+    The data is an in-memory TensorDataset, so a few workers per loader is plenty
+    """
+    num_workers = min(4, (os.cpu_count() or 0) // 2)
+    loader_kwargs = {'pin_memory': torch.cuda.is_available(), 'num_workers': num_workers}
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=2)
+    return loader_kwargs
+
+
+def get_loaders(X, Y, batch_size=64):
+    """Build the train, val and test DataLoaders over the full (float) input and
+    outcome tensors. Each loader only samples from its own subset of indices, which
+    resample_split redraws, so the loaders (and their workers) can be shared by
+    every iteration
+    """
+    dataset = TensorDataset(X, Y)
+    loader_kwargs = get_loader_kwargs()
+    return tuple(DataLoader(dataset, batch_size=batch_size, sampler=SubsetRandomSampler([]),
+                            **loader_kwargs) for _ in range(3))
 
-    train_set, val_set, test_set = train_val_test_split(X, Y)
-    train_dataset = TensorDataset(*train_set)
-    val_dataset = TensorDataset(*val_set)
-    test_dataset = TensorDataset(*test_set)
 
-    # define the model
-    model = PhysioNet(input_size=2 * k if masking_features else k)
+def resample_split(Y, train_loader, val_loader, test_loader):
+    """Draw a new stratified train/val/test split, and point the loaders at it
+    """
+    for loader, idx in zip((train_loader, val_loader, test_loader), train_val_test_indices(Y)):
+        loader.sampler.indices = idx.tolist()
 
-    optimizer = torch.optim.Adam(model.parameters())
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=True)
+
+def compile_model(model, example_inputs):
+    """Compile the model with torch.compile, where torch supports it. Compilation is
+    lazy, so a no_grad forward pass is run on example_inputs to check the backend works;
+    if anything fails, the uncompiled model is returned. Note this only checks inference:
+    the training graph is compiled on the first training step
+    """
+    try:
+        compiled_model = torch.compile(model, mode='reduce-overhead')
+        model.eval()
+        with torch.no_grad():
+            compiled_model(example_inputs)
+    except Exception as e:
+        print(f'torch.compile failed ({e}); using the uncompiled model')
+        return model
+    return compiled_model
+
+
+def uncompiled(module):
+    """The module underneath a torch.compile wrapper (or the module itself), so that
+    state dicts don't get the wrapper's '_orig_mod.' key prefix
+    """
+    return getattr(module, '_orig_mod', module)
+
+
+def copy_state_dict(module):
+    """Take an in-memory copy of a module's weights, which (unlike
+    module.state_dict()) won't change as the module keeps training
+    """
+    return {key: val.detach().clone() for key, val in uncompiled(module).state_dict().items()}
+
+
+def reset_model(model, optimizer, initial_optimizer_state):
+    """Re-initialize the model's weights and the optimizer's state in place, so
+    that the same objects can be reused across iterations
+    """
+    for module in model.modules():
+        if hasattr(module, 'reset_parameters'):
+            module.reset_parameters()
+    optimizer.load_state_dict(initial_optimizer_state)
+
+
+def train(model_path, model, optimizer, train_loader, val_loader, patience, num_epochs=None):
+    """ Training loop
+        """
+    device = next(model.parameters()).device
+    # bfloat16 has the same range as float32, so no gradient scaling is needed, but
+    # it is only fast on GPUs which support it natively
+    use_bf16 = device.type == 'cuda' and torch.cuda.is_bf16_supported()
 
     patience_counter = 0
     best_loss = np.inf
+    best_state = copy_state_dict(model)
 
     if num_epochs:
         epoch_counter = range(1, num_epochs + 1)
@@ -43,71 +108,92 @@ def train(model_path, X, Y, patience, masking_features, k,
 
     for epoch in epoch_counter:
         model.train()
-        train_loss = 0
+        train_loss = torch.zeros((), device=device)
         batch = tqdm(train_loader, total=len(train_loader),
                      desc='Epoch {:03d}'.format(epoch))
 
         for inputs, targets in batch:
+            inputs = inputs.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
             optimizer.zero_grad()
-            outputs = model(inputs)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                outputs = model(inputs)
 
-            loss = F.binary_cross_entropy(outputs, targets.unsqueeze(1))
+            # compute the loss in float32
+            loss = F.binary_cross_entropy_with_logits(outputs.float(), targets)
             loss.backward()
-            train_loss += loss.data.item()
+            train_loss += loss.detach()
             optimizer.step()
         model.eval()
-        val_loss = 0
-        predictions_list, targets_list = [], []
-        for inputs, targets in val_loader:
-            outputs = model(inputs)
-            val_loss += F.binary_cross_entropy(outputs, targets.unsqueeze(1)).item()
-            predictions_list.extend(outputs.data.tolist())
-            targets_list.extend(targets.data.tolist())
-
-        val_auc = roc_auc_score(targets_list, predictions_list)
-        train_loss = train_loss / len(train_loader)
-        val_loss = val_loss / len(val_loader)
+        val_loss = torch.zeros((), device=device)
+        num_samples = len(val_loader.sampler)
+        predictions = torch.empty(num_samples, device=device)
+        all_targets = torch.empty(num_samples, device=device)
+        offset = 0
+        with torch.no_grad():
+            for inputs, targets in val_loader:
+                inputs = inputs.to(device, non_blocking=True)
+                targets = targets.to(device, non_blocking=True)
+                outputs = model(inputs)
+                val_loss += F.binary_cross_entropy_with_logits(outputs, targets)
+                num_targets = targets.size(0)
+                predictions[offset:offset + num_targets].copy_(outputs.view(-1))
+                all_targets[offset:offset + num_targets].copy_(targets.view(-1))
+                offset += num_targets
+
+        # only synchronize with the device once per epoch
+        val_auc = roc_auc_score(all_targets.cpu().numpy(), predictions.cpu().numpy())
+        train_loss = train_loss.item() / len(train_loader)
+        val_loss = val_loss.item() / len(val_loader)
         print('loss: {:.6g}, val_loss: {:.6g}, val_auc: {:.6g}'.format(train_loss, val_loss, val_auc))
         if val_loss < best_loss:
             best_loss = val_loss
             patience_counter = 0
             print('Saving new best model')
-            torch.save(model.state_dict(), model_path)
+            best_state = copy_state_dict(model)
         else:
             patience_counter += 1
         if patience_counter == patience:
             print('Early stopping - best_loss: {:.6g}'.format(best_loss))
             break
 
-    # Load the weights of the best model
-    model.load_state_dict(torch.load(model_path))
-    return model, test_dataset
+    # Load the weights of the best model, and only write them to disk once
+    uncompiled(model).load_state_dict(best_state)
+    torch.save(best_state, model_path)
+    return model
 
 
-def predict(model, predict_dataset):
+def predict(model, predict_loader):
     """Predict loop (just calculates the prediction loss)
     """
-    predict_loader = DataLoader(predict_dataset, batch_size=64)
-    loss = 0
+    device = next(model.parameters()).device
+    loss = torch.zeros((), device=device)
 
     model.eval()
-    output_list, target_list = [], []
-    for inputs, targets in predict_loader:
-        output = model(inputs)
-        loss += F.binary_cross_entropy(output, targets.unsqueeze(1)).data.item()
-        output_list.extend(output.tolist())
-        target_list.extend(targets.tolist())
-    loss /= len(predict_loader)
-    pred_roc = roc_auc_score(target_list, output_list)
+    num_samples = len(predict_loader.sampler)
+    predictions = torch.empty(num_samples, device=device)
+    all_targets = torch.empty(num_samples, device=device)
+    offset = 0
+    with torch.no_grad():
+        for inputs, targets in predict_loader:
+            inputs = inputs.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+            output = model(inputs)
+            loss += F.binary_cross_entropy_with_logits(output, targets)
+            num_targets = targets.size(0)
+            predictions[offset:offset + num_targets].copy_(output.view(-1))
+            all_targets[offset:offset + num_targets].copy_(targets.view(-1))
+            offset += num_targets
+    loss = loss.item() / len(predict_loader)
+    pred_roc = roc_auc_score(all_targets.cpu().numpy(), predictions.cpu().numpy())
     return loss, pred_roc
 
 
 def preprocess_data(data_path, features, masking_features, k):
+    files = ['physio_input.npy', 'physio_outcomes.npy', 'physio_normalizing_dict.pkl']
     # delete all files
-    for file in ['physio_input.npy', 'physio_outcomes.npy',
-                 'physio_normalizing_dict.pkl']:
-        try: os.remove(data_path/file)
-        except FileNotFoundError: continue
+    for file in files:
+        (data_path/file).unlink(missing_ok=True)
 
     if not data_path.exists():
         data_path.mkdir()
@@ -115,13 +201,14 @@ def preprocess_data(data_path, features, masking_features, k):
     # get the original inputs
     org_data_path = data_path.parents[1]
     # check the input data exists; if it doesn't, generate it
-    for file in ['physio_input.npy', 'physio_outcomes.npy',
-                 'physio_normalizing_dict.pkl']:
-        if not (org_data_path/file).exists():
-            print(f'Missing {org_data_path/file}! Preprocessing')
-            org_preprocessor(org_data_path, masking_features)
-
-    org_input = np.load(org_data_path/'physio_input.npy')
+    if not all((org_data_path/file).exists() for file in files):
+        print(f'Missing input data in {org_data_path}! Preprocessing')
+        org_preprocessor(org_data_path, masking_features)
+
+    # memory map the input, so the full array is never held in memory alongside the
+    # selected features (every page of the file is still read, since the features
+    # are the innermost axis)
+    org_input = np.load(org_data_path/'physio_input.npy', mmap_mode='r')
     org_outcomes = np.load(org_data_path/'physio_outcomes.npy')
     with open(org_data_path/'physio_normalizing_dict.pkl', 'rb') as f:
         org_dict = pickle.load(f)
@@ -141,7 +228,7 @@ def preprocess_data(data_path, features, masking_features, k):
         relevant_indices.extend(masking_indices)
     new_dict = {feat: {'idx': idx} for idx, feat in enumerate(features)}
 
-    new_input = org_input[:, :, relevant_indices]
+    new_input = np.ascontiguousarray(org_input[:, :, relevant_indices], dtype=np.float32)
     np.save(data_path/'physio_input.npy', new_input)
     with open(data_path/'physio_normalizing_dict.pkl', 'wb') as f:
         pickle.dump(new_dict, f)
@@ -149,8 +236,13 @@ def preprocess_data(data_path, features, masking_features, k):
 
 def get_features(importance_dict_path, k):
     importance_dict = pd.read_csv(importance_dict_path)
-    importance_dict = importance_dict.sort_values('vals')
-    return importance_dict.features.values[:k]
+    # only the k lowest values are needed, not a full sort (partitioning around
+    # index k - 1 keeps this valid when k is the total number of features)
+    vals = importance_dict['vals'].to_numpy()
+    idx = np.argpartition(vals, k - 1)[:k]
+    # keep the selected features in order of importance
+    idx = idx[np.argsort(vals[idx])]
+    return importance_dict['features'].to_numpy()[idx]
 
 
 def test_topk(data_path=Path('data'), k=20, masking_features=False, random_k=False, num_iterations=40):
@@ -193,14 +285,33 @@ def test_topk(data_path=Path('data'), k=20, masking_features=False, random_k=Fal
 
     X = np.load(array_folder_path/'physio_input.npy')
     Y = np.load(array_folder_path/'physio_outcomes.npy')
+    # convert to float32 tensors once, so that each iteration only has to slice them
+    X = torch.from_numpy(X.astype(np.float32, copy=False))
+    # the outcomes are reshaped to (N, 1) to match the model's outputs
+    Y = torch.from_numpy(Y.reshape(-1, 1).astype(np.float32, copy=False))
+
+    # the loaders (and their worker processes), the model and the optimizer are
+    # reused by all the iterations; only the split, the weights and the optimizer
+    # state are redrawn
+    train_loader, val_loader, test_loader = get_loaders(X, Y)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = PhysioNet(input_size=2 * k if masking_features else k).to(device)
+    # fuse the elementwise ops into fewer kernels
+    model = compile_model(model, X[:64].to(device))
+    optimizer = torch.optim.Adam(model.parameters())
+    initial_optimizer_state = deepcopy(optimizer.state_dict())
 
     all_rocs = []
     for i in range(num_iterations):
         print(f'Iteration {i}')
-        model, test_dataset = train(array_folder_path/f'model_{i}.pickle', X, Y, patience=2,
-                                    masking_features=masking_features, k=k)
+        resample_split(Y, train_loader, val_loader, test_loader)
+        if i > 0:
+            reset_model(model, optimizer, initial_optimizer_state)
+        model = train(array_folder_path/f'model_{i}.pickle', model, optimizer, train_loader,
+                      val_loader, patience=2)
 
-        loss, pred_roc = predict(model, test_dataset)
+        loss, pred_roc = predict(model, test_loader)
         all_rocs.append(pred_roc)
     pred_roc_mean = np.mean(all_rocs)
     pred_roc_std = np.std(all_rocs)